@@ -5,8 +5,11 @@ import numpy as np
 from cyvcf2 import VCF
 
 
-def get_cyvcf(vcf_path):
-    return VCF(vcf_path)
+def get_cyvcf(vcf_path, samples=None):
+    cyvcf = VCF(vcf_path)
+    if samples is not None:
+        cyvcf.set_samples(samples)
+    return cyvcf
 
 
 def get_var_info_from_var(var):
@@ -83,6 +86,205 @@ def get_var_format_from_vcf(cyvcf, format, allele):
     var_format_df = var_format_df.replace(-2147483648, np.nan)
     return var_format_df
 
+
+VAR_STATS_COLUMNS = [
+    "NUM_CALLED",
+    "CALL_RATE",
+    "AA_FREQ",
+    "NUCL_DIVERSITY",
+    "VAR_TYPE",
+    "VAR_SUBTYPE",
+]
+
+
+# VEP CSQ fields with few distinct values, stored as categoricals to save memory
+VEP_CATEGORICAL_COLUMNS = {
+    "Allele",
+    "Consequence",
+    "IMPACT",
+    "SYMBOL",
+    "Gene",
+    "Feature_type",
+    "BIOTYPE",
+    "STRAND",
+    "VARIANT_CLASS",
+    "SYMBOL_SOURCE",
+    "CANONICAL",
+}
+
+
+def split_vep_annotations(csq, csq_info):
+    # both the transcript and the field splits are done in a single pass over the
+    # CSQ strings, without building an exploded intermediate Series
+    ids = []
+    annotations = []
+    for var_id, var_csq in zip(csq.index, csq):
+        if not isinstance(var_csq, str):
+            ids.append(var_id)
+            annotations.append([])
+            continue
+        for transcript in var_csq.split(","):
+            fields = transcript.split("|", len(csq_info) - 1)
+            # with the split limit, extra fields would end up in the last column
+            if "|" in fields[-1]:
+                raise ValueError(
+                    f"CSQ annotation of variant {var_id} has more fields than the "
+                    f"{len(csq_info)} described in the VCF header: {transcript}"
+                )
+            ids.append(var_id)
+            annotations.append(fields)
+    return pd.DataFrame(
+        annotations, index=pd.Index(ids, name=csq.index.name), columns=csq_info
+    )
+
+
+def format_vep_annotations(vep_annotations):
+    vep_annotations = vep_annotations.mask(vep_annotations == "")
+    vep_annotations = vep_annotations.reset_index().drop_duplicates().set_index("ID")
+    for col in VEP_CATEGORICAL_COLUMNS.intersection(vep_annotations.columns):
+        vep_annotations[col] = vep_annotations[col].astype("category")
+    return vep_annotations
+
+
+def empty_var_stats(n_vars):
+    return {
+        "NUM_CALLED": np.empty(n_vars, dtype=np.int32),
+        "CALL_RATE": np.empty(n_vars, dtype=np.float64),
+        "AA_FREQ": np.empty(n_vars, dtype=np.float64),
+        "NUCL_DIVERSITY": np.empty(n_vars, dtype=np.float64),
+        "VAR_TYPE": np.empty(n_vars, dtype=object),
+        "VAR_SUBTYPE": np.empty(n_vars, dtype=object),
+    }
+
+
+class GenotypeArrays(object):
+    """
+    Preallocated arrays holding the genotypes of a fixed number of records.
+
+    Allele indices are stored as int8, with -1 for missing alleles and -2 for padding of
+    calls with lower ploidy than the rest of the data. The allele array is reallocated
+    only when a record has a higher ploidy than the previous ones, or an allele index
+    above 127, which is stored as int16 instead.
+    """
+
+    def __init__(self, n_vars, n_samples, ploidy=0, dtype=np.int8):
+        self.alleles = np.full((n_vars, n_samples, ploidy), -2, dtype=dtype)
+        self.phased = np.zeros((n_vars, n_samples), dtype=bool)
+
+    def set(self, i, gts, n_alt):
+        alleles = gts[:, :-1]
+        ploidy = max(alleles.shape[1], self.alleles.shape[2])
+        dtype = self.alleles.dtype
+        # allele indices go up to the number of ALT alleles; int8 would wrap the
+        # larger ones into the missing and padding codes
+        if dtype == np.int8 and n_alt > np.iinfo(np.int8).max:
+            dtype = np.dtype(np.int16)
+        if ploidy != self.alleles.shape[2] or dtype != self.alleles.dtype:
+            self._widen(ploidy, dtype)
+        self.alleles[i, :, : alleles.shape[1]] = alleles
+        self.phased[i] = gts[:, -1]
+
+    def _widen(self, ploidy, dtype):
+        alleles = np.full(self.alleles.shape[:2] + (ploidy,), -2, dtype=dtype)
+        alleles[:, :, : self.alleles.shape[2]] = self.alleles
+        self.alleles = alleles
+
+    @classmethod
+    def concatenate(cls, parts, n_samples):
+        """
+        Concatenate the genotypes of consecutive groups of records.
+
+        Each part is released as soon as it is copied, so that at most one part is held
+        in memory besides the result.
+        """
+        n_vars = sum(len(part.phased) for part in parts)
+        ploidy = max((part.alleles.shape[2] for part in parts), default=0)
+        dtype = np.result_type(np.int8, *(part.alleles.dtype for part in parts))
+        merged = cls(n_vars, n_samples, ploidy=ploidy, dtype=dtype)
+        offset = 0
+        parts.reverse()
+        while parts:
+            part = parts.pop()
+            end = offset + len(part.phased)
+            merged.alleles[offset:end, :, : part.alleles.shape[2]] = part.alleles
+            merged.phased[offset:end] = part.phased
+            offset = end
+        return merged
+
+
+def read_vcf_fields(cyvcf, n_vars, n_samples, stats=True, genotypes=False, csq=False):
+    # a single pass over the records, collecting only the requested fields
+    var_stats = empty_var_stats(n_vars) if stats else None
+    var_genotypes = GenotypeArrays(n_vars, n_samples) if genotypes else None
+    var_csq = np.empty(n_vars, dtype=object) if csq else None
+    n_read = 0
+    for i, var in enumerate(cyvcf):
+        if i >= n_vars:
+            raise ValueError(
+                "The number of variants read does not match the variant IDs of the instance."
+            )
+        if stats:
+            var_stats["NUM_CALLED"][i] = var.num_called
+            var_stats["CALL_RATE"][i] = var.call_rate
+            var_stats["AA_FREQ"][i] = var.aaf
+            var_stats["NUCL_DIVERSITY"][i] = var.nucl_diversity
+            var_stats["VAR_TYPE"][i] = var.var_type
+            var_stats["VAR_SUBTYPE"][i] = var.var_subtype
+        if genotypes:
+            var_genotypes.set(i, var.genotype.array(), len(var.ALT))
+        if csq:
+            var_csq[i] = var.INFO.get("CSQ")
+        n_read = i + 1
+    if n_read != n_vars:
+        raise ValueError(
+            "The number of variants read does not match the variant IDs of the instance."
+        )
+    return var_stats, var_genotypes, var_csq
+
+
+def get_region_tiles(vars_metadata, tile_size=5_000_000):
+    # contigs are kept in file order so that tiles can be concatenated back
+    # in the same order as the records of the VCF; each tile comes with the
+    # number of records starting in it, and empty tiles are skipped
+    tiles = []
+    for chrom, pos in vars_metadata.groupby("CHROM", sort=False)["POS"]:
+        counts = np.bincount((pos.to_numpy() - 1) // tile_size)
+        for i in np.flatnonzero(counts):
+            start = int(i) * tile_size + 1
+            tiles.append(((str(chrom), start, start + tile_size - 1), int(counts[i])))
+    return tiles
+
+
+def merge_regions(regions, contigs):
+    # sort the regions in file order and merge the overlapping ones, so that
+    # records are read once and in the same order as in the VCF
+    contig_order = {str(chrom): i for i, chrom in enumerate(contigs)}
+    regions = sorted(
+        (
+            (str(chrom), start, end)
+            for chrom, start, end in regions
+            if str(chrom) in contig_order
+        ),
+        key=lambda region: (contig_order[region[0]], region[1]),
+    )
+    merged = []
+    for chrom, start, end in regions:
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2] + 1:
+            merged[-1] = (chrom, merged[-1][1], max(merged[-1][2], end))
+        else:
+            merged.append((chrom, start, end))
+    return merged
+
+
+def get_region_variants(cyvcf, region):
+    chrom, start, end = region
+    for var in cyvcf(f"{chrom}:{start}-{end}"):
+        # records overlapping the tile start belong to the previous tile
+        if var.POS < start:
+            continue
+        yield var
+
+
 def build_var_ID(df, alleles=False):
     if alleles == True:
         ids = (
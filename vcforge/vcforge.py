@@ -1,9 +1,18 @@
+import numpy as np
+import logging
+import os
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 import pandas as pd
 from vcforge.parsing import *
 from vcforge.utils import *
 from typing import Dict
 from cyvcf2 import VCF, Writer
 
+logger = logging.getLogger(__name__)
+
 
 class VCFClass:
     def __init__(
@@ -15,17 +24,59 @@ class VCFClass:
         create_ids_if_none=True,
         threads=1,
     ):
+        self._setup_reader(sample_info, vcf_path, sample_id_column, threads)
+        variants = get_vcf_metadata(VCF(vcf_path), add_info=add_info)
+        if create_ids_if_none:
+            ids = add_variant_ids(variants)
+        else:
+            ids = variants["ID"]
+        # set the index directly, avoiding the copy of the table made by set_index
+        variants.index = pd.Index(ids, name="ID")
+        del variants["ID"]
+        self._setup_variants(variants)
+        self.format_info = self._get_format_info()
+
+    def _setup_reader(self, sample_info, vcf_path, sample_id_column, threads):
+        """
+        Set up the sample metadata and the cyvcf2 reader of the instance.
+
+        Parameters
+        ----------
+        sample_info : pandas.DataFrame or str
+            DataFrame or path of file containing sample metadata.
+        vcf_path : str
+            Path of the VCF file.
+        sample_id_column : str
+            Name of the sample metadata column containing the sample IDs.
+        threads : int
+            Number of threads used for reading the VCF.
+        """
         self._vcf_path = vcf_path
         self._sample_id_column = sample_id_column
+        self._threads = threads
         self.sample_info, self.vcf = self._setup_data(sample_info, vcf_path)
         self.vcf.set_threads(threads)
+        self._iterator_dirty = False
         self.samples = self.vcf.samples
-        self.variants = get_vcf_metadata(VCF(vcf_path), add_info=add_info)
-        if create_ids_if_none:
-            self.variants["ID"] = add_variant_ids(self.variants)
-        self.variants = self.variants.set_index("ID")
-        self.var_ids = list(self.variants.index)
-        self.format_info = self._get_format_info()
+
+    def _setup_variants(self, variants):
+        """
+        Set the variant metadata of the instance, indexed by variant ID.
+
+        Warns if the variant IDs are not unique, and reports the size of the dataset.
+
+        Parameters
+        ----------
+        variants : pandas.DataFrame
+            Variant metadata, with one row per record of the VCF, in file order.
+        """
+        self.variants = variants
+        self.var_ids = self.variants.index.to_list()
+        if self.variants.index.duplicated().any():
+            warnings.warn(
+                "There are duplicate variant IDs; selecting variants by ID will match all of their records.",
+                stacklevel=3,
+            )
         print(
             f"VCF contains {len(self.variants)} variants over {len(self.samples)} samples"
         )
@@ -57,7 +108,8 @@ class VCFClass:
         ].astype(str)
         sample_info.set_index(self._sample_id_column, inplace=True)
         vcf = VCF(input_vcf)
-        samples = [i for i in sample_info.index if i in vcf.samples]
+        vcf_samples = set(vcf.samples)
+        samples = [i for i in sample_info.index if i in vcf_samples]
         vcf.set_samples(samples)
         sample_info = sample_info.loc[vcf.samples]
         return sample_info, vcf
@@ -75,11 +127,14 @@ class VCFClass:
             A DataFrame containing the header information for each unique format
             field in the VCF file.
         """
-        all_formats = self.variants["FORMAT"].str.split(":").explode().unique()
-        format_info = {}
-        for i in all_formats:
-            format_info[i] = self.vcf.get_header_type(i)
-        format_info = pd.DataFrame(format_info).transpose()
+        # only the few distinct FORMAT strings need splitting; dict keeps their order
+        all_formats = {}
+        for format_string in self.variants["FORMAT"].unique():
+            all_formats.update(dict.fromkeys(format_string.split(":")))
+        all_formats = list(all_formats)
+        format_info = pd.DataFrame.from_records(
+            [self.vcf.get_header_type(i) for i in all_formats], index=all_formats
+        )
         return format_info
 
     def split_by_sample_column(self, column: list) -> Dict[str, "VCF"]:
@@ -102,83 +157,207 @@ class VCFClass:
             containing the split data.
         """
         split_data: Dict[str, VCFClass] = {}
-        for name, group in self.sample_info.groupby(by=column):
-            print(name)
-            tempclass = VCFClass(
-                sample_id_column=self._sample_id_column,
-                vcf_path=self._vcf_path,
-                sample_info=group,
-            )
-            split_data[name] = tempclass
+        for name, group in self.sample_info.groupby(
+            by=column, observed=True, sort=False
+        ):
+            logger.debug("Splitting samples of group %s", name)
+            split_data[name] = self._derive_instance(group)
         return split_data
 
-    # TODO: find a way to subset variants, cyvcf apparently cant do it
-    """
-    def subset_variants(self, variant_list):
-        subsetted_variants=self.variants.loc[variant_list]
-        subsetted = VCFClass(
-            sample_id_column=self._sample_id_column,
-            vcf_path=self._vcf_path,
-            sample_info=self.sample_info,
+    def _derive_instance(self, sample_info, vcf_path=None, variants=None):
+        """
+        Create a new instance over a subset of the samples and/or variants of this instance.
+
+        The variant metadata is taken from this instance instead of being parsed again
+        from the VCF; only a new cyvcf2 reader restricted to the selected samples is opened.
+        If the samples change, variant statistics are dropped, since they were computed
+        over the samples of this instance.
+
+        Parameters
+        ----------
+        sample_info : pandas.DataFrame
+            Sample metadata of the samples to keep, indexed by sample ID.
+        vcf_path : str, optional
+            Path of the VCF of the new instance. Defaults to the VCF of this instance.
+        variants : pandas.DataFrame, optional
+            Variant metadata of the records in the VCF of the new instance. Defaults to
+            the variants of this instance.
+
+        Returns
+        -------
+        VCFClass
+            A new instance containing only the selected samples and variants.
+        """
+        if vcf_path is None:
+            vcf_path = self._vcf_path
+        if variants is None:
+            variants = self.variants
+        subset = VCFClass.__new__(VCFClass)
+        subset._setup_reader(
+            sample_info, vcf_path, self._sample_id_column, self._threads
+        )
+        if subset.samples != self.samples:
+            variants = variants.drop(columns=VAR_STATS_COLUMNS, errors="ignore")
+        subset._setup_variants(variants.copy())
+        subset.format_info = self.format_info.copy()
+        return subset
+
+    def subset_variants(self, regions, save_path):
+        """
+        Subset the variants to those starting within a list of genomic regions.
+
+        Only the records of the selected regions are read, using the index of the VCF, and
+        written to a new VCF file; a new instance over this file is returned, with the same
+        samples and the variant information of the selected variants.
+
+        Parameters
+        ----------
+        regions : list of tuple
+            Regions to keep, as (chromosome, start, end) tuples with 1-based, inclusive
+            coordinates. Overlapping regions are merged.
+        save_path : str
+            Path of the VCF file where the selected variants are saved.
+
+        Returns
+        -------
+        VCFClass
+            A new instance containing only the variants in the selected regions.
+
+        Raises
+        ------
+        ValueError
+            If the VCF is not indexed.
+        """
+        if not self._is_indexed():
+            raise ValueError(
+                "Subsetting variants by region requires an indexed (.tbi or .csi) VCF."
+            )
+        regions = merge_regions(regions, self.variants["CHROM"].unique())
+        self._start_vcf_iteration()
+        w = Writer(save_path, self.vcf)
+        for region in regions:
+            for var in get_region_variants(self.vcf, region):
+                w.write_record(var)
+        w.close()
+        chrom = self.variants["CHROM"].astype(str)
+        in_regions = np.zeros(len(self.variants), dtype=bool)
+        for region_chrom, start, end in regions:
+            in_regions |= (
+                (chrom == region_chrom).to_numpy()
+                & (self.variants["POS"] >= start).to_numpy()
+                & (self.variants["POS"] <= end).to_numpy()
+            )
+        print(f"VCF saved to {save_path}")
+        return self._derive_instance(
+            self.sample_info, vcf_path=save_path, variants=self.variants[in_regions]
         )
-        subsetted.var_ids=variant_list
-        subsetted.variants=subsetted.variants.loc[variant_ids]
-        return subsetted
-    """
 
     def reset_vcf_iterator(self):
         self.vcf = VCF(self._vcf_path)
         self.vcf.set_samples(self.samples)
+        self.vcf.set_threads(self._threads)
+        self._iterator_dirty = False
+
+    def _start_vcf_iteration(self):
+        """
+        Prepare self.vcf for a method that iterates over it.
+
+        The cyvcf2 reader is only reopened if a previous method has already consumed it,
+        instead of after every method call.
+        """
+        if self._iterator_dirty:
+            self.reset_vcf_iterator()
+        self._iterator_dirty = True
+
+    def _is_indexed(self):
+        return any(os.path.exists(self._vcf_path + ext) for ext in (".tbi", ".csi"))
+
+    def _map_regions(self, func, tile_size=5_000_000):
+        """
+        Apply a function to the variants of each genomic tile of the VCF in parallel.
+
+        The genome is split into tiles of at most tile_size bases, which are read through
+        the VCF index by a pool of self._threads worker threads. Each worker opens a single
+        cyvcf2 reader, restricted to the samples of the instance, and reuses it for all the
+        tiles it processes. Requires an indexed (.tbi or .csi) VCF.
+
+        Parameters
+        ----------
+        func : callable
+            Function receiving an iterator over the variants of a tile, and the number of
+            variants in the tile.
+        tile_size : int
+            Maximum length in bases of each tile.
+
+        Returns
+        -------
+        list
+            The results of func for each tile, in the same order as the VCF records.
+        """
+        tiles = get_region_tiles(self.variants, tile_size=tile_size)
+        if sum(n_vars for _, n_vars in tiles) != len(self.var_ids):
+            raise ValueError(
+                "The number of variants read does not match the variant IDs of the instance."
+            )
+        readers = threading.local()
+
+        def read_tile(tile):
+            region, n_vars = tile
+            # opening a reader parses the header, so it is done once per thread
+            if not hasattr(readers, "cyvcf"):
+                readers.cyvcf = get_cyvcf(self._vcf_path, self.samples)
+            return func(get_region_variants(readers.cyvcf, region), n_vars)
+
+        with ThreadPoolExecutor(max_workers=self._threads) as executor:
+            return list(executor.map(read_tile, tiles))
+
+    def _use_regions(self):
+        return self._threads > 1 and len(self.var_ids) > 0 and self._is_indexed()
 
     def format(self, format, allele):
+        self._start_vcf_iteration()
         vars_format = get_var_format_from_vcf(self.vcf, format, allele)
-        self.reset_vcf_iterator()
         return vars_format
 
     def subset_samples(self, samples):
         samples = self.sample_info.loc[samples]
         print(samples)
-        return VCFClass(
-            sample_id_column=self._sample_id_column,
-            sample_info=samples,
-            vcf_path=self._vcf_path,
-        )
+        return self._derive_instance(samples)
 
     def save_vcf(self, save_path, add_ids=False, var_ids=None, samples=None):
+        self._start_vcf_iteration()
         w = Writer(save_path, self.vcf)
-        vars_to_save = var_ids if var_ids is not None else self.var_ids
+        vars_to_save = frozenset(var_ids if var_ids is not None else self.var_ids)
         for v, id in zip(self.vcf, self.var_ids):
-            if id in vars_to_save:
-                if add_ids is True:
-                    v.ID = id
-                w.write_record(v)
-            else:
-                pass
+            if id not in vars_to_save:
+                continue
+            if add_ids is True:
+                v.ID = id
+            w.write_record(v)
         w.close()
-        self.reset_vcf_iterator()
         print(f"VCF saved to {save_path}")
 
     def get_var_stats(self, add_to_info=True):
-        var_stats = {
-            "NUM_CALLED": {},
-            "CALL_RATE": {},
-            "AA_FREQ": {},
-            "NUCL_DIVERSITY": {},
-            "VAR_TYPE": {},
-            "VAR_SUBTYPE": {},
-        }
-        for var, id in zip(self.vcf, self.var_ids):
-            var_stats["NUM_CALLED"][id] = var.num_called
-            var_stats["CALL_RATE"][id] = var.call_rate
-            var_stats["AA_FREQ"][id] = var.aaf
-            var_stats["NUCL_DIVERSITY"][id] = var.nucl_diversity
-            var_stats["VAR_TYPE"][id] = var.var_type
-            var_stats["VAR_SUBTYPE"][id] = var.var_subtype
-        var_stats = pd.DataFrame(var_stats)
-        if add_to_info is True:
-            self.variants = pd.concat([self.variants, var_stats], axis=1)
-        self.reset_vcf_iterator()
-        return var_stats
+        """
+        Compute statistics for each variant over the samples in the instance.
+
+        The statistics are the number of called genotypes, call rate, alternate allele
+        frequency, nucleotide diversity, variant type and subtype.
+        If the instance was created with threads > 1 and the VCF is indexed, the threads are
+        used not only by htslib for decompression, but also to read genomic regions in
+        parallel; on machines with few CPU cores this can be slower than serial reading.
+
+        Parameters
+        ----------
+        add_to_info : bool
+            Add the statistics to the variant information of the instance.
+
+        Returns
+        -------
+        pandas.DataFrame
+            DataFrame with the statistics for each variant, indexed by variant ID.
+        """
+        return self.compute(stats=True, add_to_info=add_to_info)["stats"]
 
     def show_genotypes(self):
         """
@@ -186,20 +365,58 @@ class VCFClass:
 
         The index of the DataFrame is the variant IDs, and the columns are the sample IDs.
         Each element of the DataFrame is a Genotype object, which can be used to access the genotype,
-        phase, and read depths of the variant in the sample.
+        phase, and read depths of the variant in the sample. For large datasets, consider
+        get_genotype_arrays, which stores the same genotypes as compact numpy arrays.
+        If the instance was created with threads > 1 and the VCF is indexed, the threads are
+        used not only by htslib for decompression, but also to read genomic regions in
+        parallel; on machines with few CPU cores this can be slower than serial reading.
 
         Returns
         -------
         pandas.DataFrame
             DataFrame with the genotypes for each variant over the samples in the instance.
         """
-        genotypes = []
-        for var in self.vcf:
-            genotypes.append([Genotype(i) for i in var.genotypes])
-        genotypes = pd.DataFrame(genotypes, index=self.var_ids, columns=self.samples)
-        self.reset_vcf_iterator()
+        if self._use_regions():
+            genotypes = chain.from_iterable(
+                self._map_regions(
+                    lambda variants, n_vars: [
+                        [Genotype(i) for i in var.genotypes] for var in variants
+                    ]
+                )
+            )
+        else:
+            self._start_vcf_iteration()
+            genotypes = [[Genotype(i) for i in var.genotypes] for var in self.vcf]
+        genotypes = pd.DataFrame(
+            list(genotypes), index=self.var_ids, columns=self.samples
+        )
         return genotypes
 
+    def get_genotype_arrays(self):
+        """
+        Return the genotypes for each variant over the samples in the instance as numpy arrays.
+
+        Unlike show_genotypes, which builds one Genotype object per call, the genotypes are
+        stored in two compact arrays that can be filtered and aggregated with numpy.
+        Allele indices are encoded as int8, or as int16 if any record has more than 127 ALT
+        alleles, with -1 for missing alleles and -2 for padding of calls with lower ploidy
+        than the rest of the data.
+        If the instance was created with threads > 1 and the VCF is indexed, the threads are
+        used not only by htslib for decompression, but also to read genomic regions in
+        parallel; on machines with few CPU cores this can be slower than serial reading.
+
+        Returns
+        -------
+        dict
+            Dictionary with the following keys:
+            - "alleles": int8 (or int16) array of shape (variants, samples, ploidy) with the
+              allele indices.
+            - "phased": bool array of shape (variants, samples) with the phasing of each call.
+            - "variants": list of the variant IDs, in the order of the first axis.
+            - "samples": list of the sample IDs, in the order of the second axis.
+        """
+        return self.compute(stats=False, genotypes=True)["genotypes"]
+
     def extract_vep_annotations(self, add_to_info=False):
         """
         Extract VEP annotations from the VCF file.
@@ -209,7 +426,8 @@ class VCFClass:
         as described in the VCF header. If add_to_info is True, the variant info dataframe
         will be merged with the annotations. Keep in mind that there are likely multiple
         annotations per variant, therefore the resulting dataframe will have multiple rows
-        per variant ID.
+        per variant ID. Annotation fields with few distinct values (e.g. Consequence, IMPACT,
+        BIOTYPE) are stored as pandas categoricals to reduce memory usage.
 
         Returns
         -------
@@ -227,19 +445,10 @@ class VCFClass:
                 "CSQ column not found in variants. This column is required for VEP annotations. Consider parsing VCF with add_info=True"
             )
 
-        csq_info = (
-            self.vcf.get_header_type("CSQ")["Description"]
-            .split(" ")[6]
-            .strip('"')
-            .split("|")
-        )
-        csq_data = self.variants["CSQ"].str.split(",").explode()
-        vep_annotations = csq_data.str.split("|", expand=True)
-        vep_annotations.columns = csq_info
-        vep_annotations = vep_annotations.replace("", np.nan)
-        vep_annotations = (
-            vep_annotations.reset_index().drop_duplicates().set_index("ID")
+        vep_annotations = split_vep_annotations(
+            self.variants["CSQ"], self._get_csq_info()
         )
+        vep_annotations = format_vep_annotations(vep_annotations)
         if add_to_info:
             vep_annotations = self.variants.drop(columns=["CSQ"]).merge(
                 vep_annotations, left_index=True, right_index=True
@@ -247,6 +456,123 @@ class VCFClass:
 
         return vep_annotations
 
+    def _get_csq_info(self):
+        try:
+            csq_header = self.vcf.get_header_type("CSQ")
+        except KeyError:
+            raise ValueError(
+                "CSQ field not found in the VCF header. This field is required for VEP annotations."
+            )
+        return csq_header["Description"].split(" ")[6].strip('"').split("|")
+
+    def compute(self, stats=True, genotypes=False, vep=False, add_to_info=True):
+        """
+        Compute variant statistics, genotype arrays and VEP annotations in a single pass over the VCF.
+
+        Calling get_var_stats, get_genotype_arrays and extract_vep_annotations separately
+        reads and decodes the whole VCF once per method; this function reads each record
+        once and collects only the requested outputs. The VEP annotations are read from
+        the CSQ INFO field of the records, so the instance does not need to be created
+        with add_info=True.
+        The outputs are preallocated from the number of variants and filled in place, and
+        all the requested outputs are held in memory until the pass is complete. The
+        genotype arrays usually dominate: alleles take one byte per allele call (variants x
+        samples x ploidy), or two if any record has more than 127 ALT alleles, plus one byte
+        per call for the phasing. The allele array is reallocated, briefly doubling its
+        memory, when a record has a higher ploidy than the previous ones or needs int16.
+        When genomic regions are read in parallel, each region is collected in its own
+        arrays and then copied into the final ones, so the peak memory is about twice the
+        size of the outputs. If memory is a concern, request the outputs in separate calls,
+        or use threads=1.
+        If the instance was created with threads > 1 and the VCF is indexed, the threads are
+        used not only by htslib for decompression, but also to read genomic regions in
+        parallel; on machines with few CPU cores this can be slower than serial reading.
+
+        Parameters
+        ----------
+        stats : bool
+            Compute the variant statistics, as in get_var_stats.
+        genotypes : bool
+            Collect the genotype arrays, as in get_genotype_arrays.
+        vep : bool
+            Extract the VEP annotations, as in extract_vep_annotations.
+        add_to_info : bool
+            Add the variant statistics to the variant information of the instance.
+
+        Returns
+        -------
+        dict
+            Dictionary with the requested outputs under the "stats", "genotypes" and
+            "vep" keys.
+
+        Raises
+        ------
+        ValueError
+            If vep is True and the CSQ field is not found in the VCF header.
+        """
+        if vep:
+            csq_info = self._get_csq_info()
+
+        n_samples = len(self.samples)
+
+        def read_fields(variants, n_vars):
+            return read_vcf_fields(
+                variants,
+                n_vars,
+                n_samples,
+                stats=stats,
+                genotypes=genotypes,
+                csq=vep,
+            )
+
+        if self._use_regions():
+            tiles = self._map_regions(read_fields)
+            if stats:
+                var_stats = {
+                    col: np.concatenate([tile[0][col] for tile in tiles])
+                    for col in VAR_STATS_COLUMNS
+                }
+            if vep:
+                var_csq = np.concatenate([tile[2] for tile in tiles])
+            if genotypes:
+                var_genotypes = GenotypeArrays.concatenate(
+                    [tile[1] for tile in tiles], n_samples
+                )
+            del tiles
+        else:
+            self._start_vcf_iteration()
+            var_stats, var_genotypes, var_csq = read_fields(self.vcf, len(self.var_ids))
+
+        outputs = {}
+        if stats:
+            var_stats = pd.DataFrame(var_stats, index=self.var_ids)
+            if add_to_info is True:
+                # assign columns in place instead of copying the whole table with concat
+                same_index = self.variants.index.equals(var_stats.index)
+                for col in var_stats.columns:
+                    self.variants[col] = (
+                        var_stats[col].values if same_index else var_stats[col]
+                    )
+            outputs["stats"] = var_stats
+        if genotypes:
+            outputs["genotypes"] = {
+                "alleles": var_genotypes.alleles,
+                "phased": var_genotypes.phased,
+                "variants": self.var_ids,
+                "samples": self.samples,
+            }
+        if vep:
+            csq = pd.Series(var_csq, index=pd.Index(self.var_ids, name="ID"))
+            outputs["vep"] = format_vep_annotations(
+                split_vep_annotations(csq, csq_info)
+            )
+        return outputs
+
+
+# string representations of genotypes, keyed by (alleles, phased); the number of
+# distinct genotypes is tiny compared to the number of calls that get displayed
+_GT_STR_CACHE = {}
+
 
 class Genotype(object):
     __slots__ = ("alleles", "phased")
@@ -256,7 +582,12 @@ class Genotype(object):
         self.phased = li[-1]
 
     def __str__(self):
-        sep = "/|"[int(self.phased)]
-        return sep.join("0123."[a] for a in self.alleles)
+        key = (tuple(self.alleles), bool(self.phased))
+        gt_str = _GT_STR_CACHE.get(key)
+        if gt_str is None:
+            sep = "|" if key[1] else "/"
+            gt_str = sep.join("." if a < 0 else str(a) for a in key[0])
+            _GT_STR_CACHE[key] = gt_str
+        return gt_str
 
     __repr__ = __str__